@@ -23,60 +23,124 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import atexit
+import json
 import logging
+import logging.handlers
 import os
+import queue
 import signal
+import socket
+import ssl
 import sys
 import threading
 from configparser import ConfigParser
 from datetime import datetime
-from time import sleep, strftime, time
+from email.utils import formatdate
+from time import sleep, time
+from types import SimpleNamespace
 
+import ijson
 import paho.mqtt.client as mqtt_client
 import requests
-from crontab import CronTab
 from dateutil.tz import tzlocal
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError
+from urllib3.util.retry import Retry
+
+try:
+    import automationhat
+
+    RELAY = automationhat.relay.one
+    RELAY_VERIFY = True
+except ImportError:
+    import mock
+
+    # There's nothing to read back from a fake relay
+    RELAY = mock.Mock()
+    RELAY_VERIFY = False
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Setup some global variables because I'm lazy
 CFG = None
+CFG_CACHE = None
 CRON_KILL = None
 CRON_SKIP = None
 CRON_THREAD = None
+EVENT_HANDLERS = {}
+FORECAST_MEMO = None
 WATER_DURATION = None
 WATER_KILL = None
 WATER_START = None
+WATER_STOP = threading.Event()
 WATER_THREAD = None
 LOGGER = None
+PUBLISH_CLIENT = None
+SHUTDOWN = threading.Event()
+THREAD_LOCK = threading.Lock()
+
+# Share one http session so every forecast fetch gets the same retry policy
+SESSION = requests.Session()
+SESSION_ADAPTER = HTTPAdapter(
+    pool_connections=4, pool_maxsize=8, max_retries=Retry(total=2, backoff_factor=0.2),
+)
+SESSION.mount("https://", SESSION_ADAPTER)
+SESSION.mount("http://", SESSION_ADAPTER)
+# Build the broker TLS context once, and reuse it across reconnects
+MQTT_SSL_CONTEXT = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+MQTT_SSL_CONTEXT.load_verify_locations(
+    cafile=f"{os.path.dirname(__file__)}/ssl/letsencrypt-root.pem"
+)
+MQTT_SSL_CONTEXT.options |= ssl.OP_NO_COMPRESSION
+SHUTDOWN_SIGNALS = {signal.SIGINT, signal.SIGTERM}
+WEATHERFLOW_HOST = "https://swd.weatherflow.com"
+FORECAST_FIELDS = {
+    "forecast.daily.item.day_num": "day_num",
+    "forecast.daily.item.precip_probability": "precip_probability",
+}
+# Past this a cached forecast may be for the wrong days, so don't fall back to it
+FORECAST_STALE_MAX = 86400
+LAST_WATER_FILE = os.path.expanduser("~/.cache/bedwetter/last_water")
 
 
 def cb_on_connect(client, userdata, flags, rc):
     """ Connect to mqtt broker and subscribe to the bedwetter topic """
     LOGGER.info("Connected to the mqtt broker")
-    client.subscribe(f'{CFG["bedwetter"]["mqtt_topic"]}/event/#')
-    if "schedule" in CFG["bedwetter"] and CFG["bedwetter"]["schedule"]:
+    client.subscribe(CFG_CACHE.mqtt_subscription)
+    if CFG_CACHE.schedule:
         global CRON_KILL
         global CRON_SKIP
         global CRON_THREAD
-        CRON_KILL = False
-        CRON_SKIP = False
-        CRON_THREAD = threading.Thread(
-            target=cron_check, args=(lambda: CRON_KILL, lambda: CRON_SKIP,)
-        )
-        CRON_THREAD.daemon = True
-        CRON_THREAD.start()
-        if not CRON_THREAD.is_alive():
-            LOGGER.error("Unable to start cron check process")
-
         global WATER_KILL
         global WATER_START
         global WATER_THREAD
-        WATER_THREAD = threading.Thread(
-            target=water_check, args=(lambda: WATER_KILL, lambda: WATER_START,)
-        )
-        WATER_THREAD.daemon = True
-        WATER_THREAD.start()
-        if not WATER_THREAD.is_alive():
-            LOGGER.error("Unable to start water check process")
+        # Reconnects can race with disconnects, never run two of each thread
+        with THREAD_LOCK:
+            if CRON_THREAD is None or not CRON_THREAD.is_alive():
+                CRON_KILL = threading.Event()
+                CRON_SKIP = threading.Event()
+                CRON_THREAD = threading.Thread(
+                    target=cron_check, args=(CRON_KILL, CRON_SKIP,)
+                )
+                CRON_THREAD.daemon = True
+                CRON_THREAD.start()
+                if not CRON_THREAD.is_alive():
+                    LOGGER.error("Unable to start cron check process")
+
+            if WATER_THREAD is None or not WATER_THREAD.is_alive():
+                WATER_KILL = threading.Event()
+                WATER_START = threading.Event()
+                WATER_THREAD = threading.Thread(
+                    target=water_check, args=(WATER_KILL, WATER_START,)
+                )
+                WATER_THREAD.daemon = True
+                WATER_THREAD.start()
+                if not WATER_THREAD.is_alive():
+                    LOGGER.error("Unable to start water check process")
     else:
         LOGGER.info("Not starting cron check thread, cron time string is not set")
 
@@ -86,77 +150,60 @@ def cb_on_disconnect(client, userdata, rc):
     LOGGER.info("Disconnected from the mqtt broker")
     # Kill CRON_THREAD if it is running, otherwise we'll end up with
     # a new one on every reconnection to the mqtt broker
-    try:
-        if CRON_THREAD.is_alive():
-            LOGGER.info("Trying to kill cron check, this can take a few seconds")
-            global CRON_KILL
-            CRON_KILL = True
+    with THREAD_LOCK:
+        if CRON_THREAD is not None and CRON_THREAD.is_alive():
+            LOGGER.info("Trying to kill cron check")
+            CRON_KILL.set()
             CRON_THREAD.join()
-        if WATER_THREAD.is_alive():
-            LOGGER.info("Trying to kill water check, this can take a few seconds")
-            global WATER_KILL
-            WATER_KILL = True
+        if WATER_THREAD is not None and WATER_THREAD.is_alive():
+            LOGGER.info("Trying to kill water check")
+            WATER_KILL.set()
+            # Wake the thread up so it notices it has been killed
+            WATER_START.set()
             WATER_THREAD.join()
-    except NameError:
-        pass
 
 
 def cb_on_message(client, userdata, msg):
     """ On receipt of a message, do stuff """
-    if "event/wateringStart" in msg.topic:
-        LOGGER.info("Received wateringStart mqtt message")
-        global WATER_DURATION
-        global WATER_START
-        if not msg.payload:
-            WATER_DURATION = CFG["bedwetter"].getint("watering_duration")
-        else:
-            WATER_DURATION = int(msg.payload)
-        WATER_START = True
-    elif "event/wateringSkip" in msg.topic:
-        LOGGER.info("Received wateringSkip mqtt message")
-        if CRON_THREAD.is_alive():
-            global CRON_SKIP
-            CRON_SKIP = True
-            LOGGER.info("Skipping next automated watering")
-    elif "event/wateringStop" in msg.topic:
-        # This won't actually interrupt water_on() which blocks the read loop
-        LOGGER.info("Received wateringStop mqtt message")
-        global WATER_KILL
-        WATER_KILL = True
+    handler = EVENT_HANDLERS.get(msg.topic)
+    if handler:
+        handler(msg)
+
+
+def cb_on_socket_open(client, userdata, sock):
+    """ Disable Nagle so small mqtt packets aren't held back waiting on acks """
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
 
 def check_if_watering():
     """ Check if we should water today, and if so water """
     LOGGER.info("Checking if we're going to water today.")
     water = False
-    if (int(time()) - int(CFG["bedwetter"]["last_water"])) > (
-        86400 * int(CFG["bedwetter"]["threshold_days"])
-    ):
+    if (int(time()) - CFG_CACHE.last_water) > CFG_CACHE.threshold_seconds:
         LOGGER.info(
             "More than %s days since last watering, time to water",
-            CFG["bedwetter"]["threshold_days"],
+            CFG_CACHE.threshold_days,
         )
         water = True
     else:
-        forecast = fetch_forecast()["forecast"]["daily"]
-        for day in forecast:
-            if day["day_num"] == int(strftime("%d")) and day[
-                "precip_probability"
-            ] < CFG["bedwetter"].getint("threshold_percent"):
-                LOGGER.info(
-                    "%s%% chance of precipitation in the next day, time to water",
-                    f'{day["precip_probability"]:.0f}',
-                )
-                water = True
+        # Without a forecast assume rain rather than watering blind
+        day = fetch_forecast(datetime.now().day) or {}
+        precip_probability = day.get("precip_probability", 100)
+        if precip_probability < CFG_CACHE.threshold_percent:
+            LOGGER.info(
+                "%.0f%% chance of precipitation in the next day, time to water",
+                precip_probability,
+            )
+            water = True
     if water:
         publish(
-            "event/wateringStart", CFG["bedwetter"].getint("water_duration"),
+            "event/wateringStart", CFG_CACHE.water_duration,
         )
     else:
         log_and_publish(
             "log/wateringSkipped",
             "Not watering today",
-            CFG["bedwetter"].getboolean("notify_on_inaction"),
+            publish_message=CFG_CACHE.notify_on_inaction,
         )
 
 
@@ -169,144 +216,329 @@ def config_load():
     if "bedwetter" not in CFG:
         sys.exit(f"Fatal Error: Unable to read from configuration file {config_file}")
 
+    # Parse everything once, ConfigParser converts from strings on every access
+    global CFG_CACHE
+    section = CFG["bedwetter"]
+    CFG_CACHE = SimpleNamespace(
+        debug=section.getboolean("debug"),
+        forecast_ttl=section.getint("forecast_ttl", 1800),
+        last_water=last_water_read(section.getint("last_water", 0)),
+        log_file=section.get("log_file"),
+        log_to_file=section.getboolean("log_to_file"),
+        mqtt_password=section.get("mqtt_password"),
+        mqtt_port=section.getint("mqtt_port"),
+        mqtt_server=section.get("mqtt_server"),
+        mqtt_topic=section.get("mqtt_topic"),
+        mqtt_username=section.get("mqtt_username"),
+        notify_on_failure=section.getboolean("notify_on_failure"),
+        notify_on_inaction=section.getboolean("notify_on_inaction"),
+        notify_on_service=section.getboolean("notify_on_service"),
+        notify_on_success=section.getboolean("notify_on_success"),
+        schedule=section.get("schedule"),
+        station_id=section.get("station_id"),
+        threshold_days=section.getint("threshold_days"),
+        threshold_percent=section.getint("threshold_percent"),
+        threshold_seconds=86400 * section.getint("threshold_days"),
+        timeout=section.getint("timeout"),
+        water_duration=section.getint("water_duration"),
+        weatherflow_api_key=section.get("weatherflow_api_key"),
+    )
+    # Topic and URL strings never change, so build them once rather than per use
+    CFG_CACHE.mqtt_prefix = f"{CFG_CACHE.mqtt_topic}/"
+    CFG_CACHE.mqtt_subscription = f"{CFG_CACHE.mqtt_prefix}event/#"
+    CFG_CACHE.weatherflow_url = (
+        f"{WEATHERFLOW_HOST}/swd/rest/better_forecast/"
+        f"?api_key={CFG_CACHE.weatherflow_api_key}"
+        f"&station_id={CFG_CACHE.station_id}"
+    )
+    # Keep a cache per station, so changing station never serves the old one
+    CFG_CACHE.forecast_cache = os.path.expanduser(
+        f"~/.cache/bedwetter/forecast-{CFG_CACHE.station_id}.json"
+    )
 
-def config_update():
-    """ Updates the config file with any changes that have been made """
-    config_file = os.path.expanduser("~/.config/bedwetter/bedwetter.cfg")
-    try:
-        with open(config_file, "w") as cfg_handle:
-            CFG.write(cfg_handle)
-    except EnvironmentError:
-        log_and_publish(
-            "log/wateringFailure",
-            "Could not write to configuration file {config_file}",
-            CFG["bedwetter"].getboolean("notify_on_failure"),
-        )
+    # Map full event topics to their handlers so dispatch is a single lookup
+    global EVENT_HANDLERS
+    EVENT_HANDLERS = {
+        f"{CFG_CACHE.mqtt_prefix}event/wateringSkip": event_watering_skip,
+        f"{CFG_CACHE.mqtt_prefix}event/wateringStart": event_watering_start,
+        f"{CFG_CACHE.mqtt_prefix}event/wateringStop": event_watering_stop,
+    }
 
 
 def create_paho_client():
     """ Setup and create a Paho client """
-    # Paho is not thread safe, so we'll end up making a few clients
     paho_client = mqtt_client.Client()
-    paho_client.tls_set(
-        ca_certs=f"{os.path.dirname(__file__)}/ssl/letsencrypt-root.pem"
-    )
+    paho_client.tls_set_context(MQTT_SSL_CONTEXT)
     paho_client.username_pw_set(
-        CFG["bedwetter"]["mqtt_username"], CFG["bedwetter"]["mqtt_password"],
+        CFG_CACHE.mqtt_username, CFG_CACHE.mqtt_password,
     )
+    paho_client.on_socket_open = cb_on_socket_open
     return paho_client
 
 
 def cron_check(kill, skip):
-    """ Poll until it is time to trigger a watering """
-    LOGGER.info(
-        "Started thread to water on schedule (%s)", CFG["bedwetter"]["schedule"]
-    )
+    """ Wait until it is time to trigger a watering """
+    LOGGER.info("Started thread to water on schedule (%s)", CFG_CACHE.schedule)
+
+    # Only needed when there's a schedule, so don't pay for it otherwise
+    from crontab import CronTab
 
-    cron = CronTab(f'{CFG["bedwetter"]["schedule"]}')
-    # The higher this value is, the longer it takes to kill this thread
-    sleep_interval = 10
+    cron = CronTab(CFG_CACHE.schedule)
+    next_cron = time() + cron.next(default_utc=False)
     while True:
-        if kill():
-            LOGGER.info("Received kill signal, killing cron check thread")
-            break
-        time_until_cron = cron.next(default_utc=False)
-        if CFG["bedwetter"].getboolean("debug"):
-            LOGGER.debug("Time until cron: %s seconds", int(time_until_cron))
-        if time_until_cron <= sleep_interval:
-            # Sleep until it's closer to cron time to avoid a possible race
-            sleep(time_until_cron)
-            if not skip():
-                check_if_watering()
-            else:
-                global CRON_SKIP
-                CRON_SKIP = False
-                log_and_publish(
-                    "log/wateringSkipped",
-                    "Watering skipped",
-                    CFG["bedwetter"].getboolean("notify_on_inaction"),
-                )
+        time_until_cron = next_cron - time()
+        if time_until_cron > 0:
+            # Block until cron time, or return early if we're asked to die. Long
+            # waits are cut to an hour and the schedule re-read after each one,
+            # so clock changes (NTP, DST) get picked up
+            if kill.wait(timeout=min(time_until_cron, 3600)):
+                LOGGER.info("Received kill signal, killing cron check thread")
+                break
+            if time_until_cron > 3600:
+                next_cron = time() + cron.next(default_utc=False)
+            continue
+        if time_until_cron < -60:
+            # The clock jumped past cron time, don't water at the wrong time
+            LOGGER.info("Clock changed past the scheduled time, rescheduling")
+        elif not skip.is_set():
+            check_if_watering()
         else:
-            sleep(sleep_interval)
+            skip.clear()
+            log_and_publish(
+                "log/wateringSkipped",
+                "Watering skipped",
+                publish_message=CFG_CACHE.notify_on_inaction,
+            )
+        next_cron = time() + cron.next(default_utc=False)
+        LOGGER.debug("Time until cron: %s seconds", int(next_cron - time()))
 
 
 def water_check(kill, start):
-    """ Poll until it is time to water """
+    """ Wait until it is time to water """
     LOGGER.info("Started thread to check for watering events")
 
-    # The higher this value is, the longer it takes to kill this thread
-    sleep_interval = 10
     while True:
-        if kill():
+        start.wait()
+        if kill.is_set():
             LOGGER.info("Received kill signal, killing water check thread")
-
             break
-        if start():
-            global WATER_START
-            WATER_START = False
-            LOGGER.info("Water on")
+        start.clear()
+        if SHUTDOWN.is_set():
+            LOGGER.info("Shutting down, not starting a watering")
+            continue
+        LOGGER.info("Water on")
+        try:
             water_on(WATER_DURATION)
+        finally:
             water_off()
-        else:
-            sleep(sleep_interval)
 
 
-def fetch_forecast():
-    """ Fetch a weather forecast from WeatherFlow """
+def event_watering_skip(msg):
+    """ Skip the next scheduled watering """
+    LOGGER.info("Received wateringSkip mqtt message")
+    if CRON_THREAD is not None and CRON_THREAD.is_alive():
+        CRON_SKIP.set()
+        LOGGER.info("Skipping next automated watering")
+
+
+def event_watering_start(msg):
+    """ Start watering, for the requested duration if one was sent """
+    LOGGER.info("Received wateringStart mqtt message")
+    global WATER_DURATION
+    if not msg.payload:
+        WATER_DURATION = CFG_CACHE.water_duration
+    else:
+        WATER_DURATION = int(msg.payload)
+    if WATER_THREAD is not None and WATER_THREAD.is_alive():
+        # Clear any earlier stop here rather than in water_on, so a stop or
+        # shutdown that lands after this can't be lost
+        if not SHUTDOWN.is_set():
+            WATER_STOP.clear()
+        WATER_START.set()
+
+
+def event_watering_stop(msg):
+    """ Interrupt a watering that is in progress """
+    LOGGER.info("Received wateringStop mqtt message")
+    WATER_STOP.set()
+
+
+def fetch_forecast(day_num):
+    """ Fetch the daily forecast for day_num, from the cache if it is fresh """
+    global FORECAST_MEMO
+    # Try memory first, then disk, and only then go out to WeatherFlow
+    if FORECAST_MEMO and time() - FORECAST_MEMO[0] < CFG_CACHE.forecast_ttl:
+        daily = FORECAST_MEMO[1]
+    else:
+        try:
+            cache_mtime = os.path.getmtime(CFG_CACHE.forecast_cache)
+        except EnvironmentError:
+            cache_mtime = None
+        if cache_mtime and time() - cache_mtime < CFG_CACHE.forecast_ttl:
+            daily = forecast_cache_read()
+        else:
+            daily = fetch_weatherflow_forecast(cache_mtime)
+            # Stamp with the cache's real age, so a stale fallback isn't
+            # remembered as fresh
+            try:
+                cache_mtime = os.path.getmtime(CFG_CACHE.forecast_cache)
+            except EnvironmentError:
+                cache_mtime = time()
+        FORECAST_MEMO = (cache_mtime, daily) if daily else None
+    for day in daily or []:
+        if day["day_num"] == day_num:
+            return day
+
+
+def fetch_weatherflow_forecast(cache_mtime=None):
+    """ Fetch the daily forecast from WeatherFlow """
+    headers = {}
+    if cache_mtime:
+        headers["If-Modified-Since"] = formatdate(cache_mtime, usegmt=True)
     try:
-        weatherflow_url = (
-            "https://swd.weatherflow.com/swd/rest/better_forecast/"
-            f'?api_key={CFG["bedwetter"]["weatherflow_api_key"]}'
-            f'&station_id={CFG["bedwetter"]["station_id"]}'
-        )
-        request = requests.get(
-            weatherflow_url, timeout=int(CFG["bedwetter"]["timeout"])
-        )
-        request.encoding = "utf-8"
-        return request.json()
+        # Stream the response and stop parsing once the daily forecast is read,
+        # the hourly forecast that follows it is never used
+        with SESSION.get(
+            CFG_CACHE.weatherflow_url,
+            headers=headers,
+            timeout=CFG_CACHE.timeout,
+            stream=True,
+        ) as request:
+            if request.status_code == 304:
+                # Nothing new upstream, so reset the cache's age and reuse it
+                os.utime(CFG_CACHE.forecast_cache)
+                daily = forecast_cache_read()
+                if daily:
+                    return daily
+            else:
+                request.raise_for_status()
+                request.raw.decode_content = True
+                # Only pull out the fields we actually use, rather than building
+                # a dict of everything WeatherFlow tells us about each day
+                daily = []
+                for prefix, event, value in ijson.parse(request.raw, use_float=True):
+                    if prefix == "forecast.daily.item" and event == "start_map":
+                        daily.append({})
+                    elif prefix in FORECAST_FIELDS:
+                        daily[-1][FORECAST_FIELDS[prefix]] = value
+                    elif prefix == "forecast.daily" and event == "end_array":
+                        forecast_cache_write(daily)
+                        return daily
     except requests.exceptions.ConnectTimeout:
-        log_and_publish(
-            "log/wateringFailure",
-            f'Error: WeatherFlow API timed out after {CFG["bedwetter"]["timeout"]} seconds',
-            CFG["bedwetter"].getboolean("notify_on_failure"),
+        failure = (
+            "Error: WeatherFlow API timed out after %s seconds",
+            CFG_CACHE.timeout,
         )
     except requests.exceptions.RequestException:
+        failure = ("Error: There was an error connecting to the WeatherFlow API",)
+    except (HTTPError, ijson.JSONError):
+        failure = ("Error: There was an error reading the WeatherFlow forecast",)
+    except EnvironmentError:
+        failure = ("Error: Unable to refresh the cached WeatherFlow forecast",)
+    else:
+        # A 200 without a daily forecast is how WeatherFlow reports most errors,
+        # and a 304 lands here too if the cache couldn't be read back
+        failure = ("Error: No daily forecast was available from WeatherFlow",)
+
+    # A stale forecast beats no forecast when WeatherFlow is having a bad day
+    if cache_mtime and time() - cache_mtime < FORECAST_STALE_MAX:
+        LOGGER.info(*failure)
+        daily = forecast_cache_read()
+        if daily:
+            LOGGER.info("Falling back to the cached forecast")
+            return daily
+    log_and_publish(
+        "log/wateringFailure", *failure, publish_message=CFG_CACHE.notify_on_failure
+    )
+
+
+def forecast_cache_read():
+    """ Read the daily forecast from the on-disk cache """
+    try:
+        with open(CFG_CACHE.forecast_cache, "rb") as cache_handle:
+            if orjson:
+                return orjson.loads(cache_handle.read())
+            return json.load(cache_handle)
+    except (EnvironmentError, ValueError):
+        LOGGER.info("Unable to read forecast cache %s", CFG_CACHE.forecast_cache)
+        return None
+
+
+def forecast_cache_write(daily):
+    """ Atomically replace the on-disk forecast cache """
+    try:
+        os.makedirs(os.path.dirname(CFG_CACHE.forecast_cache), exist_ok=True)
+        with open(f"{CFG_CACHE.forecast_cache}.tmp", "wb") as cache_handle:
+            if orjson:
+                cache_handle.write(orjson.dumps(daily))
+            else:
+                cache_handle.write(json.dumps(daily).encode())
+        os.replace(f"{CFG_CACHE.forecast_cache}.tmp", CFG_CACHE.forecast_cache)
+    except EnvironmentError:
+        LOGGER.info("Unable to write forecast cache %s", CFG_CACHE.forecast_cache)
+
+
+def last_water_read(default):
+    """ Read the last watering time, falling back to default if it's missing """
+    try:
+        with open(LAST_WATER_FILE) as last_water_handle:
+            return int(last_water_handle.read())
+    except (EnvironmentError, ValueError):
+        return default
+
+
+def last_water_write(timestamp):
+    """ Persist the last watering time without rewriting the config file """
+    # Don't wear out the SD card rewriting a value that hasn't changed
+    if last_water_read(None) == timestamp:
+        return
+    try:
+        os.makedirs(os.path.dirname(LAST_WATER_FILE), exist_ok=True)
+        # Write to a temporary file and rename it over the original, so a crash
+        # part way through can't leave a truncated timestamp. Not worth an
+        # fsync, losing this on a crash just means an extra watering
+        with open(f"{LAST_WATER_FILE}.tmp", "w") as last_water_handle:
+            last_water_handle.write(str(timestamp))
+        os.replace(f"{LAST_WATER_FILE}.tmp", LAST_WATER_FILE)
+    except EnvironmentError:
         log_and_publish(
             "log/wateringFailure",
-            "Error: There was an error connecting to the WeatherFlow API",
-            CFG["bedwetter"].getboolean("notify_on_failure"),
+            "Could not write to last watering file %s",
+            LAST_WATER_FILE,
+            publish_message=CFG_CACHE.notify_on_failure,
         )
 
 
-def log_and_publish(topic, payload, publish_message=True):
+def log_and_publish(topic, payload, *args, publish_message=True):
     """ Log a message to the logger, and optionally publish to mqtt """
-    LOGGER.info(payload)
+    # Formatting is left to the logger, and only done here if we publish
+    LOGGER.info(payload, *args)
     if publish_message:
-        publish(topic, payload)
+        publish(topic, payload % args if args else payload)
+
+
+def mqtt_disconnect(client):
+    """ Disconnect from the mqtt broker and stop the network loop """
+    client.disconnect()
+    client.loop_stop()
 
 
 def publish(topic, payload, retain=False):
     """ Publish messages to mqtt """
-    client = create_paho_client()
-    try:
-        client.connect(
-            CFG["bedwetter"]["mqtt_server"],
-            port=CFG["bedwetter"].getint("mqtt_port"),
-            keepalive=60,
-        )
-    # Paho swallows exceptions so I doubt this even works
-    except Exception as paho_e:
-        LOGGER.info("Unable to connect to mqtt broker, %s", paho_e)
+    publish_multiple([{"topic": topic, "payload": payload, "retain": retain}])
 
-    (return_code, _) = client.publish(
-        f'{CFG["bedwetter"]["mqtt_topic"]}/{topic}',
-        payload=payload,
-        qos=0,
-        retain=retain,
-    )
-    if return_code != 0:
-        LOGGER.error("Unable to publish message, return code is %s", return_code)
-    client.disconnect()
+
+def publish_multiple(msgs):
+    """ Publish a batch of messages to mqtt back to back on one connection """
+    for msg in msgs:
+        (return_code, _) = PUBLISH_CLIENT.publish(
+            CFG_CACHE.mqtt_prefix + msg["topic"],
+            payload=msg["payload"],
+            qos=msg.get("qos", 0),
+            retain=msg.get("retain", False),
+        )
+        if return_code != 0:
+            LOGGER.error("Unable to publish message, return code is %s", return_code)
 
 
 def setup_logger():
@@ -317,34 +549,49 @@ def setup_logger():
     )
 
     logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
+    # Let the logger drop debug messages itself rather than checking at each call
+    logger.setLevel(logging.DEBUG if CFG_CACHE.debug else logging.INFO)
 
     # Log to stdout
     stream_handler = logging.StreamHandler(sys.stdout)
     stream_handler.setFormatter(formatter)
-    logger.addHandler(stream_handler)
+    handlers = [stream_handler]
 
     # Optionally log to file
-    if "log_file" in CFG["bedwetter"] and CFG["bedwetter"].getboolean("log_to_file"):
-        file_handler = logging.FileHandler(
-            os.path.expanduser(CFG["bedwetter"]["log_file"])
-        )
+    if CFG_CACHE.log_file and CFG_CACHE.log_to_file:
+        file_handler = logging.FileHandler(os.path.expanduser(CFG_CACHE.log_file))
         file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
+        handlers.append(file_handler)
+
+    # Hand records off to a background thread so a slow SD card write can't
+    # stall the paho network loop, and flush whatever is queued on exit
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    atexit.register(listener.stop)
     return logger
 
 
+def relay_settled(want_on):
+    """ Briefly poll the relay until it reports the state we asked for """
+    if not RELAY_VERIFY:
+        return True
+    for _ in range(10):
+        if RELAY.is_on() == want_on:
+            return True
+        sleep(0.01)
+    return False
+
+
 def water_off():
     """ Stop watering """
-    try:
-        import automationhat
-    except ImportError:
-        import mock
-
-        automationhat = mock.Mock()
     LOGGER.info("Turning water off")
-    automationhat.relay.one.off()
-    if not automationhat.relay.one.is_off():
+    try:
+        RELAY.off()
+    except EnvironmentError as relay_e:
+        LOGGER.error("Unable to turn relay off, %s", relay_e)
+    if not relay_settled(False):
         log_and_publish(
             "log/wateringRunaway", "Watering failed to stop",
         )
@@ -352,32 +599,44 @@ def water_off():
 
 def water_on(duration):
     """ Start watering """
-    try:
-        import automationhat
-    except ImportError:
-        import mock
-
-        automationhat = mock.Mock()
+    if SHUTDOWN.is_set():
+        LOGGER.info("Shutting down, not turning water on")
+        return
     LOGGER.info("Watering for %s seconds", duration)
-    automationhat.relay.one.on()
-    sleep(duration)
-    if automationhat.relay.one.is_on():
+    try:
+        RELAY.on()
+        started = relay_settled(True)
+    except EnvironmentError as relay_e:
+        LOGGER.error("Unable to turn relay on, %s", relay_e)
+        started = False
+    if not started:
         log_and_publish(
-            "log/wateringSuccess",
-            "Watering succeeded",
-            CFG["bedwetter"].getboolean("notify_on_success"),
+            "log/wateringFailure",
+            "Watering failed to start",
+            publish_message=CFG_CACHE.notify_on_failure,
         )
+    # Wait out the duration, unless a wateringStop or shutdown cuts it short
+    elif WATER_STOP.wait(timeout=duration):
+        LOGGER.info("Watering stopped early")
+    else:
+        LOGGER.info("Watering succeeded")
+        msgs = []
+        if CFG_CACHE.notify_on_success:
+            msgs.append(
+                {"topic": "log/wateringSuccess", "payload": "Watering succeeded"}
+            )
         # Log and retain the last watering date
-        CFG["bedwetter"]["last_water"] = f"{time():.0f}"
+        CFG_CACHE.last_water = int(time())
+        last_water_write(CFG_CACHE.last_water)
         # Home Assistant is really picky about date formats, so no timestamp
-        publish("log/wateringDate", datetime.now(tzlocal()).isoformat(), True)
-        config_update()
-    else:
-        log_and_publish(
-            "log/wateringFailure",
-            "Watering failed to start",
-            CFG["bedwetter"].getboolean("notify_on_failure"),
+        msgs.append(
+            {
+                "topic": "log/wateringDate",
+                "payload": datetime.now(tzlocal()).isoformat(),
+                "retain": True,
+            }
         )
+        publish_multiple(msgs)
 
 
 def main():
@@ -385,6 +644,11 @@ def main():
     # Load config file settings
     config_load()
 
+    # Block shutdown signals before any threads start (the log listener
+    # included), so they all inherit the mask and only the main thread's
+    # sigwait() ever sees them
+    signal.pthread_sigmask(signal.SIG_BLOCK, SHUTDOWN_SIGNALS)
+
     # Setup logging
     global LOGGER
     LOGGER = setup_logger()
@@ -395,7 +659,13 @@ def main():
     client.on_disconnect = cb_on_disconnect
     client.on_message = cb_on_message
 
-    if CFG["bedwetter"].getboolean("debug"):
+    # Publish over the main client's connection rather than opening new ones
+    global PUBLISH_CLIENT
+    PUBLISH_CLIENT = client
+    # Disconnecting on exit flushes anything still queued
+    atexit.register(mqtt_disconnect, client)
+
+    if CFG_CACHE.debug:
         # Enable Paho logging using standard logger interface
         client.enable_logger(logger=LOGGER)
     else:
@@ -405,9 +675,7 @@ def main():
     # Connect to mqtt broker
     try:
         client.connect(
-            CFG["bedwetter"]["mqtt_server"],
-            port=CFG["bedwetter"].getint("mqtt_port"),
-            keepalive=60,
+            CFG_CACHE.mqtt_server, port=CFG_CACHE.mqtt_port, keepalive=60,
         )
     # Paho swallows exceptions so I doubt this even works
     except Exception as paho_e:
@@ -416,28 +684,30 @@ def main():
     log_and_publish(
         "log/startingUp",
         "Startup has completed",
-        CFG["bedwetter"].getboolean("notify_on_service"),
+        publish_message=CFG_CACHE.notify_on_service,
     )
 
-    # Catch SIGTERM when being run non-interactively
-    def shutdown(*args):
+    # Run the network loop in the background so publishes never wait on it
+    client.loop_start()
+
+    # Wait here for a signal to shut down, instead of having a handler
+    # interrupt the main thread at some arbitrary point
+    signum = signal.sigwait(SHUTDOWN_SIGNALS)
+    # Cut short any watering in progress, and refuse to start new ones,
+    # before doing anything else
+    SHUTDOWN.set()
+    WATER_STOP.set()
+    if signum == signal.SIGTERM:
         log_and_publish(
             "log/shuttingDown",
             "Caught SIGTERM, shutting down",
-            CFG["bedwetter"].getboolean("notify_on_service"),
+            publish_message=CFG_CACHE.notify_on_service,
         )
-        # Make sure water is off before we exit
-        water_off()
-        sys.exit(0)
-
-    signal.signal(signal.SIGTERM, shutdown)
-
-    try:
-        client.loop_forever()
-    except KeyboardInterrupt:
-        LOGGER.info("KeyboardInterrupt received, shutting down")
-        client.disconnect()
-        sys.exit(0)
+    else:
+        LOGGER.info("Caught SIGINT, shutting down")
+    # Make sure water is off before we exit
+    water_off()
+    sys.exit(0)
 
 
 if sys.version_info >= (3, 7):
@@ -8,13 +8,14 @@ setup(
         [console_scripts]
         bedwetter=bedwetter.__main__:main
     """,
-    extras_require={"dev": ["mock"]},
+    extras_require={"dev": ["mock"], "orjson": ["orjson"]},
     include_package_data=True,
     install_requires=[
         "automationhat ; platform_system=='Linux'",
         "crontab",
         "configparser",
-        "paho-mqtt",
+        "ijson>=3.1",
+        "paho-mqtt>=1.5",
         "python-dateutil",
         "requests",
         "smbus ; platform_system=='Linux'",